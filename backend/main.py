@@ -1,20 +1,33 @@
 # main.py
-import os, json, base64, logging, re, requests, hashlib, time
-from io import BytesIO
+import os, json, logging, re, hashlib, time, asyncio, copy, threading
+from collections import OrderedDict
+from functools import lru_cache
 from typing import Optional, List, Dict, Any
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
-from PIL import Image
+import httpx
 from dotenv import load_dotenv
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import Response, JSONResponse as _JSONResponseBase
 from pydantic import BaseModel
 from google import genai
 try:
-    from google.genai.errors import ClientError
+    from google.genai.errors import ClientError, ServerError
 except Exception:
-    ClientError = Exception  # fallback
+    ClientError = ServerError = Exception  # fallback
+try:
+    from pybase64 import b64encode  # SIMD-accelerated, same API as base64
+except ImportError:
+    from base64 import b64encode  # fallback
+try:
+    import orjson  # C-accelerated JSON encode/decode
+except ImportError:
+    orjson = None  # fallback to stdlib json
+try:
+    import redis.asyncio as aioredis  # shared cache/rate-limit state across workers
+except ImportError:
+    aioredis = None
 
 # ==========================================================
 # 🚀 SETUP
@@ -35,8 +48,56 @@ if not HF_TOKEN:
     raise SystemExit("❌ Set HF_TOKEN in backend/.env")
 HF_MODEL = os.getenv("HF_TEXT_MODEL", "HuggingFaceH4/zephyr-7b-beta:featherless-ai")
 HF_CHAT_URL = "https://api-inference.huggingface.co/v1/chat/completions"
-
-app = FastAPI(title="🐾 AI Pet Assistant (stable images)")
+HF_HEADERS = {"Authorization": f"Bearer {HF_TOKEN}", "Content-Type": "application/json", "Accept": "application/json"}
+
+# Shared pooled client so HF calls reuse keep-alive connections instead of
+# paying a fresh TCP+TLS handshake per request. The transport retries failed connects.
+http_client = httpx.AsyncClient(
+    timeout=90,
+    transport=httpx.AsyncHTTPTransport(
+        retries=2,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    ),
+)
+HF_RETRY_STATUSES = {429, 502, 503, 504}
+HF_MAX_RETRIES = 2
+# Cap in-flight upstream calls per process; extra requests queue here instead of drawing 429s.
+HF_SEM = asyncio.Semaphore(int(os.getenv("HF_CONCURRENCY", "5")))
+GEMINI_SEM = asyncio.Semaphore(int(os.getenv("GEMINI_CONCURRENCY", "5")))
+# /api/train: if HF hasn't answered after this many seconds, race Gemini against it.
+# 0 keeps the cheaper HF-first, Gemini-on-failure order.
+TRAIN_HEDGE_AFTER = float(os.getenv("TRAIN_HEDGE_AFTER", "0"))
+
+# With several uvicorn workers, caches and rate limits only agree if they live in Redis.
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_CACHE_TTL = int(os.getenv("REDIS_CACHE_TTL", "3600"))
+redis_client = None
+if REDIS_URL:
+    if aioredis is None:
+        logger.warning("REDIS_URL is set but redis is not installed; using per-process state")
+    else:
+        redis_client = aioredis.from_url(REDIS_URL)
+
+if orjson is not None:
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+
+    def _json_dumps_sorted(obj: Any) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+
+    class JSONResponse(_JSONResponseBase):
+        def render(self, content: Any) -> bytes:
+            return orjson.dumps(content)
+else:
+    _json_loads = json.loads
+    def _json_dumps(obj: Any) -> bytes:
+        # same compact form JSONResponse renders
+        return json.dumps(obj, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+    def _json_dumps_sorted(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), sort_keys=True).encode("utf-8")
+    JSONResponse = _JSONResponseBase
+
+app = FastAPI(title="🐾 AI Pet Assistant (stable images)", default_response_class=JSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:5173", "http://127.0.0.1:5173"],
@@ -51,6 +112,12 @@ async def _log_routes():
         if getattr(r, "path", None):
             logger.info("ROUTE %s %s", getattr(r, "methods", ""), r.path)
 
+@app.on_event("shutdown")
+async def _close_clients():
+    await http_client.aclose()
+    if redis_client is not None:
+        await redis_client.aclose()
+
 # ==========================================================
 # ⚙️ HELPERS
 # ==========================================================
@@ -61,24 +128,59 @@ def clamp01(x, default=0.0):
     except Exception:
         return default
 
+def _fastclamp(x, default=0.0):
+    # model scores are nearly always plain numbers; skip float()/try for those
+    t = type(x)
+    if t is float:
+        return x if 0.0 <= x <= 1.0 else (0.0 if x < 0.0 else 1.0)
+    if t is int:
+        return float(x) if 0 <= x <= 1 else (0.0 if x < 0 else 1.0)
+    return clamp01(x, default)
+
 SMART_QUOTES = {
     "\u201c": '"', "\u201d": '"', "\u201e": '"', "\u201f": '"',
     "\u2018": "'", "\u2019": "'", "\u201a": "'", "\u201b": "'",
 }
 
+_SMART_TRANS = str.maketrans(SMART_QUOTES)
+
+_RE_FENCE_START = re.compile(r"^```[a-zA-Z0-9_-]*\s*")
+_RE_FENCE_END = re.compile(r"\s*```$")
+_RE_COMMENT = re.compile(r"//.*?$|/\*[\s\S]*?\*/", re.MULTILINE)
+_RE_SMART = re.compile("[\u2018-\u201f]")
+# Trailing comma | bareword key | single-quoted string, rewritten in one scan.
+# Double-quoted strings are matched whole and kept, so their contents are never rewritten.
+# An unterminated string swallows the rest of the text unchanged; otherwise every later
+# quote would start another scan to the end (quadratic on runs of escaped quotes).
+_RE_STRUCT = re.compile(
+    r",\s*([}\]])"
+    r"|([{\[,]\s*)([A-Za-z_][A-Za-z0-9_\-]*)(\s*):"
+    r"|'([^'\\]*(?:\\.[^'\\]*)*)'"
+    r'|"[^"\\]*(?:\\.[^"\\]*)*"'
+    r"""|["'][\s\S]*"""
+)
+_RE_STRAY_INNER = re.compile(r'("[^"\n]{0,200}?)(?<!\\)"([A-Za-z][^"]{0,20}?)"(?=[^"]*")')
+_RE_WS = re.compile(r"\s+")
+_RE_NON_SLUG = re.compile(r"[^a-z0-9]+")
+# Anything the non-structural repair passes (fences, comments, quote fixes) act on.
+_NEEDS_REPAIR = re.compile(r"[`'\u2018-\u201f]|//|/\*")
+
 def _extract_balanced(s: str, open_ch: str, close_ch: str) -> str | None:
-    start = None
+    # Jump between bracket positions with str.find instead of visiting every char.
+    start = s.find(open_ch)
+    if start < 0:
+        return None
     depth = 0
-    for i, ch in enumerate(s):
-        if ch == open_ch:
-            if depth == 0:
-                start = i
+    o, c = start, s.find(close_ch, start)
+    while c >= 0:
+        if 0 <= o < c:
             depth += 1
-        elif ch == close_ch:
-            if depth > 0:
-                depth -= 1
-                if depth == 0 and start is not None:
-                    return s[start:i+1]
+            o = s.find(open_ch, o + 1)
+        else:
+            depth -= 1
+            if depth == 0:
+                return s[start:c+1]
+            c = s.find(close_ch, c + 1)
     return None
 
 def extract_balanced_json_or_array(s: str) -> str | None:
@@ -87,47 +189,88 @@ def extract_balanced_json_or_array(s: str) -> str | None:
         return cand
     return _extract_balanced(s, '[', ']')
 
-def sanitize_json_text(t: str) -> str:
+def _fix_structure(m):
+    g = m.lastindex
+    if g is None:
+        return m.group(0)
+    if g == 1:
+        return m.group(1)
+    if g == 4:
+        return f'{m.group(2)}"{m.group(3)}"{m.group(4)}:'
+    inner = m.group(5).replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{inner}"'
+
+_UNPARSED = object()
+
+def _repair(t: str) -> tuple[str, Any]:
+    """Structural fixes; returns the repaired text and its decoded value (or _UNPARSED)."""
+    # every rewriting branch needs one of these; without them only strings would match
+    if "," in t or ":" in t or "'" in t:
+        t = _RE_STRUCT.sub(_fix_structure, t)
+    # the stray-quote heuristic also hits well-formed strings; only use it if still broken
+    try:
+        return t, _json_loads(t)
+    except Exception:
+        pass
+    # a stray pair inside a string means at least four double quotes
+    if t.count('"') < 4:
+        return t, _UNPARSED
+    fixed = _RE_STRAY_INNER.sub(r'\1\"\2\"', t)
+    if fixed != t:
+        try:
+            return fixed, _json_loads(fixed)
+        except Exception:
+            pass
+    return fixed, _UNPARSED
+
+def _sanitize(t: str) -> tuple[str, Any]:
     t = (t or "").strip()
     if t.startswith("```"):
-        t = re.sub(r"^```[a-zA-Z0-9_-]*\s*", "", t)
-        t = re.sub(r"\s*```$", "", t)
-    for k, v in SMART_QUOTES.items():
-        t = t.replace(k, v)
-    t = re.sub(r"//.*?$", "", t, flags=re.MULTILINE)
-    t = re.sub(r"/\*[\s\S]*?\*/", "", t)
+        t = _RE_FENCE_START.sub("", t)
+        t = _RE_FENCE_END.sub("", t)
+    # cheap presence checks first; most model output has neither
+    if _RE_SMART.search(t):
+        t = t.translate(_SMART_TRANS)
+    if "/" in t:
+        t = _RE_COMMENT.sub("", t)
     candidate = extract_balanced_json_or_array(t)
     if candidate:
         t = candidate
-    t = re.sub(r",\s*([}\]])", r"\1", t)
-    t = re.sub(r'([{\[,]\s*)([A-Za-z_][A-Za-z0-9_\-]*)(\s*):', r'\1"\2"\3:', t)
-    def _fix_single_quotes(m):
-        inner = m.group(1)
-        inner = inner.replace('\\', '\\\\').replace('"', '\\"')
-        return f'"{inner}"'
-    t = re.sub(r"'([^'\\]*(?:\\.[^'\\]*)*)'", _fix_single_quotes, t)
-    t = re.sub(r'(".*?)(?<!\\)"([A-Za-z][^"]{0,20}?)"(?=(.*?"))', r'\1\"\2\"', t)
-    return t
+    return _repair(t)
+
+def sanitize_json_text(t: str) -> str:
+    return _sanitize(t)[0]
+
+def _looks_bracketed(t: str) -> bool:
+    if not t or _NEEDS_REPAIR.search(t):
+        return False
+    if t[0] == "{":
+        return t[-1] == "}"
+    # the extractor prefers an inner object over the array, so only skip it when there is none
+    return t[0] == "[" and t[-1] == "]" and "{" not in t
 
 def parse_json_loose(text: str):
     try:
-        return json.loads(text)
+        return _json_loads(text)
     except Exception:
         pass
-    t = sanitize_json_text(text)
-    try:
-        return json.loads(t)
-    except Exception:
-        try:
-            if t.strip().startswith('['):
-                return {"_data": json.loads(t)}
-        except Exception:
-            pass
-        preview = (t or "")[:800].replace("\n", "\\n")
-        raise ValueError(f"Could not parse JSON after repairs. First 800 chars: {preview}")
-
+    t = (text or "").strip()
+    if _looks_bracketed(t):
+        # Usually a bare JSON value, where only the structural fixes can help;
+        # trailing prose with braces still needs the full sanitizer's extraction.
+        _, value = _repair(t)
+        if value is not _UNPARSED:
+            return value
+    # repairs already tried decoding; reuse that instead of parsing again
+    t, value = _sanitize(t)
+    if value is not _UNPARSED:
+        return value
+    preview = (t or "")[:800].replace("\n", "\\n")
+    raise ValueError(f"Could not parse JSON after repairs. First 800 chars: {preview}")
+
+@lru_cache(maxsize=1024)
 def _slug(s: str) -> str:
-    return re.sub(r"[^a-z0-9]+", "-", (s or "pet").lower()).strip("-") or "pet"
+    return _RE_NON_SLUG.sub("-", (s or "pet").lower()).strip("-") or "pet"
 
 # ==========================================================
 # 🧯 RATE LIMIT + CACHE HELPERS
@@ -138,54 +281,322 @@ class TokenBucket:
     refill_per_sec: float
     tokens: float
     last: float
+    name: str = ""  # Redis key; unnamed buckets stay per-process
+    # refill + take must be one step, or concurrent callers can spend the same tokens
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
     def allow(self, cost: float = 1.0) -> bool:
-        now = time.time()
-        elapsed = now - self.last
-        self.tokens = min(self.capacity, self.tokens + elapsed * self.refill_per_sec)
-        self.last = now
-        if self.tokens >= cost:
-            self.tokens -= cost
-            return True
-        return False
+        with self._lock:
+            now = time.time()
+            elapsed = now - self.last
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.refill_per_sec)
+            self.last = now
+            if self.tokens >= cost:
+                self.tokens -= cost
+                return True
+            return False
+
+    async def acquire(self, cost: float = 1.0) -> bool:
+        if redis_client is None or not self.name:
+            return self.allow(cost)
+        try:
+            return bool(await _redis_take(
+                keys=[f"rl:{self.name}"],
+                args=[self.capacity, self.refill_per_sec, time.time(), cost],
+            ))
+        except Exception:
+            logger.warning("Redis rate limit unavailable; using local bucket for %s", self.name)
+            return self.allow(cost)
+
+# Same refill/take as TokenBucket.allow, run atomically inside Redis.
+_TOKEN_BUCKET_LUA = """
+local cap, rate, now, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local b = redis.call('HMGET', KEYS[1], 'tokens', 'last')
+local tokens = tonumber(b[1]) or cap
+local last = tonumber(b[2]) or now
+tokens = math.min(cap, tokens + math.max(0, now - last) * rate)
+local ok = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    ok = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'last', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(cap / rate) + 1)
+return ok
+"""
+_redis_take = redis_client.register_script(_TOKEN_BUCKET_LUA) if redis_client is not None else None
+
+PREDICT_BUCKET   = TokenBucket(capacity=5, refill_per_sec=5.0, tokens=5.0, last=time.time(), name="predict")
+VOICE_BUCKET     = TokenBucket(capacity=5, refill_per_sec=5.0, tokens=5.0, last=time.time(), name="voice")
+CAPTION_BUCKET   = TokenBucket(capacity=5, refill_per_sec=5.0, tokens=5.0, last=time.time(), name="caption")
+RECOMMEND_BUCKET = TokenBucket(capacity=5, refill_per_sec=5.0, tokens=5.0, last=time.time(), name="recommend")
+TRAIN_BUCKET     = TokenBucket(capacity=5, refill_per_sec=5.0, tokens=5.0, last=time.time(), name="train")
+FOOD_BUCKET      = TokenBucket(capacity=5, refill_per_sec=5.0, tokens=5.0, last=time.time(), name="food")
 
-PREDICT_BUCKET   = TokenBucket(capacity=5, refill_per_sec=5.0, tokens=5.0, last=time.time())
-VOICE_BUCKET     = TokenBucket(capacity=5, refill_per_sec=5.0, tokens=5.0, last=time.time())
-CAPTION_BUCKET   = TokenBucket(capacity=5, refill_per_sec=5.0, tokens=5.0, last=time.time())
-RECOMMEND_BUCKET = TokenBucket(capacity=5, refill_per_sec=5.0, tokens=5.0, last=time.time())
-TRAIN_BUCKET     = TokenBucket(capacity=5, refill_per_sec=5.0, tokens=5.0, last=time.time())
-FOOD_BUCKET      = TokenBucket(capacity=5, refill_per_sec=5.0, tokens=5.0, last=time.time())
-
-_PREDICT_CACHE: Dict[str, Dict[str, Any]]   = {}
-_VOICE_CACHE: Dict[str, Dict[str, Any]]     = {}
-_CAPTION_CACHE: Dict[str, Dict[str, Any]]   = {}
-_RECOMMEND_CACHE: Dict[str, Dict[str, Any]] = {}
-_TRAIN_CACHE: Dict[str, Dict[str, Any]]     = {}
-_FOOD_CACHE: Dict[str, Dict[str, Any]]      = {}
-
-def _call_gemini_json(model: str, parts: list, *, temperature: float = 0.2) -> Dict[str, Any]:
-    try:
-        res = gemini_client.models.generate_content(
-            model=model,
-            contents=[{"role": "user", "parts": parts}],
-            config={"temperature": temperature, "response_mime_type": "application/json"},
-        )
-        raw = (getattr(res, "text", None) or "").strip()
-        if not raw:
-            return {}
+@dataclass
+class AdaptiveBucket(TokenBucket):
+    """TokenBucket whose refill rate tracks upstream throttling (AIMD)."""
+    rate_min: float = 0.2
+    rate_max: float = 10.0
+    increase: float = 0.5  # added to the rate per success
+    decrease: float = 0.5  # rate multiplier per throttle
+    paused_until: float = 0.0
+    @property
+    def degraded(self) -> bool:
+        """True while the upstream asked us to back off; callers can skip the call outright."""
+        return time.time() < self.paused_until
+
+    def allow(self, cost: float = 1.0) -> bool:
+        return not self.degraded and super().allow(cost)
+
+    def penalize(self, retry_after_s: float) -> None:
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.time() + retry_after_s)
+
+    def on_success(self) -> None:
+        with self._lock:
+            self.refill_per_sec = min(self.rate_max, self.refill_per_sec + self.increase)
+
+    def on_failure(self) -> None:
+        with self._lock:
+            self.refill_per_sec = max(self.rate_min, self.refill_per_sec * self.decrease)
+            self.tokens = 0.0
+
+# Gemini quota is per key, not per endpoint: every call draws from this one bucket.
+GEMINI_BUCKET = AdaptiveBucket(capacity=10, refill_per_sec=5.0, tokens=10.0, last=time.time())
+
+@dataclass
+class CircuitBreaker:
+    """
+    CLOSED: calls go through. OPEN: after failure_threshold consecutive failures,
+    calls are refused for reset_timeout seconds. HALF_OPEN: one probe call is let
+    through; its outcome closes or re-opens the circuit.
+    """
+    failure_threshold: int = 5
+    reset_timeout: float = 30.0
+    state: str = "closed"
+    failures: int = 0
+    opened_at: float = 0.0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                return True
+            return False
+
+    def success(self) -> None:
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.time()
+
+GEMINI_BREAKER = CircuitBreaker()
+
+class LRUCache(OrderedDict):
+    """Dict with a size cap that evicts the least recently used entry.
+
+    With ttl (seconds) set, entries older than that read as missing.
+    serialized=True means values are already JSON bytes and are stored as-is.
+    With a namespace and REDIS_URL set, aget/aset also read/write through Redis
+    so every worker sees the same entries; the local dict stays as a hot layer.
+    """
+    def __init__(self, maxsize: int = 512, namespace: str = "", ttl: Optional[float] = None,
+                 serialized: bool = False):
+        super().__init__()
+        self.maxsize = maxsize
+        self.namespace = namespace
+        self.ttl = ttl
+        self.serialized = serialized
+        self._stamps: Dict[Any, float] = {}
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if self.ttl is not None and time.monotonic() - self._stamps.get(key, 0.0) > self.ttl:
+            super().__delitem__(key)
+            self._stamps.pop(key, None)
+            raise KeyError(key)
+        self.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if self.ttl is not None:
+            self._stamps[key] = time.monotonic()
+        if len(self) > self.maxsize:
+            old, _ = self.popitem(last=False)
+            self._stamps.pop(old, None)
+
+    async def aget(self, key, default=None):
+        value = self.get(key)
+        if value is not None:
+            return value
+        if redis_client is None or not self.namespace:
+            return default
+        try:
+            raw = await redis_client.get(f"{self.namespace}:{key}")
+        except Exception:
+            logger.warning("Redis get failed for %s", self.namespace)
+            return default
+        if raw is None:
+            return default
+        value = raw if self.serialized else _json_loads(raw)
+        self[key] = value
+        return value
+
+    async def aset(self, key, value):
+        self[key] = value
+        if redis_client is None or not self.namespace:
+            return
         try:
-            return json.loads(raw)
+            await redis_client.setex(f"{self.namespace}:{key}", int(self.ttl or REDIS_CACHE_TTL),
+                                     value if self.serialized else _json_dumps(value))
         except Exception:
-            return parse_json_loose(raw) or {}
+            logger.warning("Redis set failed for %s", self.namespace)
+
+_PREDICT_CACHE: Dict[str, Dict[str, Any]]   = LRUCache(512, namespace="predict")
+_VOICE_CACHE: Dict[str, Dict[str, Any]]     = LRUCache(512, namespace="voice")
+# caption/recommend/food hold encoded response bodies, so a hit skips serialization
+_CAPTION_CACHE: Dict[str, bytes]            = LRUCache(512, namespace="caption", ttl=1800, serialized=True)
+_RECOMMEND_CACHE: Dict[str, bytes]          = LRUCache(512, namespace="recommend", ttl=1800, serialized=True)
+_TRAIN_CACHE: Dict[str, Dict[str, Any]]     = LRUCache(2048, namespace="train", ttl=6 * 3600)
+_FOOD_CACHE: Dict[str, bytes]               = LRUCache(512, namespace="food", ttl=1800, serialized=True)
+_GATE_CACHE: Dict[str, Dict[str, Any]]      = LRUCache(1024)
+
+def _json_body(body: bytes) -> Response:
+    return Response(body, media_type="application/json")
+
+async def _cache_json(cache: LRUCache, key: str, out: Any) -> Response:
+    """Encode once, store the bytes, and answer with the same bytes."""
+    body = _json_dumps(out)
+    await cache.aset(key, body)
+    return _json_body(body)
+
+def _retry_after(e: Exception) -> Optional[float]:
+    """Seconds to back off, from a Retry-After header or the RetryInfo detail of a 429 body."""
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    try:
+        if headers and headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    details = getattr(e, "details", None)
+    err = details.get("error", details) if isinstance(details, dict) else {}
+    for d in (err.get("details") or []) if isinstance(err, dict) else []:
+        delay = d.get("retryDelay") if isinstance(d, dict) else None
+        if isinstance(delay, str) and delay.endswith("s"):
+            try:
+                return float(delay[:-1])
+            except ValueError:
+                pass
+    return None
+
+async def _call_gemini_json(model: str, parts: list, *, temperature: float = 0.2) -> Dict[str, Any]:
+    if not GEMINI_BUCKET.allow():
+        logger.info("Gemini bucket empty; returning fallback marker.")
+        return {"__FALLBACK__": True}
+    # checked after the bucket so a half-open probe is never granted and then dropped
+    if not GEMINI_BREAKER.allow():
+        return {"__FALLBACK__": True}
+    try:
+        async with GEMINI_SEM:
+            res = await gemini_client.aio.models.generate_content(
+                model=model,
+                contents=[{"role": "user", "parts": parts}],
+                config={"temperature": temperature, "response_mime_type": "application/json"},
+            )
     except ClientError as e:
+        # a 4xx still means Gemini is up; only 5xx/transport errors trip the breaker
+        GEMINI_BREAKER.success()
         msg = getattr(e, "message", "") or str(e)
-        if "429" in msg or "RESOURCE_EXHAUSTED" in msg or "quota" in msg.lower():
+        if getattr(e, "code", None) == 429 or "429" in msg or "RESOURCE_EXHAUSTED" in msg or "quota" in msg.lower():
             logger.warning("Gemini 429/Quota hit; returning fallback marker.")
+            GEMINI_BUCKET.on_failure()
+            retry_after = _retry_after(e)
+            if retry_after:
+                GEMINI_BUCKET.penalize(retry_after)
             return {"__FALLBACK__": True}
         logger.exception("Gemini client error")
         return {}
+    except ServerError:
+        logger.exception("Gemini server error")
+        GEMINI_BUCKET.on_failure()
+        GEMINI_BREAKER.failure()
+        return {}
     except Exception:
         logger.exception("Gemini request failed unexpectedly")
+        GEMINI_BREAKER.failure()
+        return {}
+    GEMINI_BUCKET.on_success()
+    GEMINI_BREAKER.success()
+    raw = (getattr(res, "text", None) or "").strip()
+    if not raw:
         return {}
+    try:
+        return _json_loads(raw)
+    except Exception:
+        pass
+    # a malformed reply is the model's fault, not an outage: leave the breaker alone
+    try:
+        return parse_json_loose(raw) or {}
+    except Exception as e:
+        logger.warning("Gemini returned unparseable JSON: %s", e)
+        return {}
+
+def _parts_key(parts: list, temperature: float, blob_key: str | None = None) -> bytes:
+    # blob_key: caller's digest of the inline payload (uploads are hashed while read),
+    # so multi-MB media isn't rehashed on the event loop for every call
+    h = hashlib.blake2b(str(temperature).encode(), digest_size=16)
+    for p in parts:
+        blob = p.get("inline_data")
+        if blob:
+            h.update(b"\x00blob:" + blob["mime_type"].encode() + b"\x00")
+            if blob_key is None:
+                data = blob["data"]
+                h.update(data.encode("ascii") if isinstance(data, str) else data)
+        else:
+            h.update(b"\x00text\x00" + p.get("text", "").encode("utf-8"))
+    if blob_key is not None:
+        h.update(b"\x00key:" + blob_key.encode())
+    return h.digest()
+
+class Coalescer:
+    """
+    Collapses identical concurrent Gemini calls onto one upstream request.
+    Double-submits and client retries share the in-flight call instead of
+    each spending a round-trip (and quota) on the same prompt.
+    """
+    def __init__(self, model: str):
+        self.model = model
+        self._inflight: Dict[bytes, asyncio.Task] = {}
+
+    async def submit(self, parts: list, *, temperature: float = 0.2, blob_key: str | None = None) -> Dict[str, Any]:
+        key = _parts_key(parts, temperature, blob_key)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(_call_gemini_json(self.model, parts, temperature=temperature))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _t, k=key: self._inflight.pop(k, None))
+        # shield: one caller going away must not cancel the call for the others
+        data = await asyncio.shield(task)
+        # handlers post-process results in place, so each caller gets its own copy
+        return copy.deepcopy(data)
+
+GEMINI = Coalescer(GEMINI_MODEL)
 
 # ==========================================================
 # 🖼️ PLACEHOLDER IMAGES
@@ -249,12 +660,16 @@ SYNONYMS = {
     "parrot": "parakeet",
 }
 
+_RE_PAREN = re.compile(r"\s*\([^)]*\)")
+
+@lru_cache(maxsize=1024)
 def _canonical(name: str) -> str:
     n = (name or "").lower().strip()
-    n = re.sub(r"\s*\([^)]*\)", "", n)
-    n = re.sub(r"\s+", " ", n)
+    n = _RE_PAREN.sub("", n)
+    n = _RE_WS.sub(" ", n)
     return n
 
+@lru_cache(maxsize=256)
 def _placeholder_for(pet_name: str) -> Optional[str]:
     if not pet_name:
         return None
@@ -320,22 +735,21 @@ class TrainIn(BaseModel):
     problem: str
     goal: str | None = None
 
-def build_prompt(petType: str, age: str | None, problem: str, goal: str | None) -> str:
-    return f"""
+_PROMPT_PREFIX = """\
 You are a certified pet trainer. Create a gentle, stepwise 7-day training plan.
 
 Return STRICT JSON ONLY:
-{{
+{
   "title": string,
   "summary": string,
   "dailyRoutine": string[],
-  "sevenDay": [{{"day": number, "activities": string[]}}],
+  "sevenDay": [{"day": number, "activities": string[]}],
   "rewards": string[],
-  "videoLinks": [{{"title": string, "url": string}}],
+  "videoLinks": [{"title": string, "url": string}],
   "notes": string[],
-  "meta": {{"seed": string}},
+  "meta": {"seed": string},
   "friendlyName": string
-}}
+}
 
 Rules:
 - friendlyName: "pup" for Dog, "kitty" for Cat, else "pet".
@@ -345,38 +759,60 @@ Rules:
 - Never use a double-quote inside values; use backticks if needed.
 
 Context:
-Pet type: {petType}
-Age: {age or "unknown"}
-Problem: {problem}
-Desired outcome: {goal or "not specified"}
-""".strip()
+"""
 
-def call_hf(prompt: str) -> str:
-    headers = {"Authorization": f"Bearer {HF_TOKEN}", "Content-Type": "application/json", "Accept": "application/json"}
-    payload = {
-        "model": HF_MODEL,
-        "messages": [
-            {"role": "system", "content": "Return a SINGLE VALID JSON object matching the schema. No prose/markdown."},
-            {"role": "user", "content": prompt},
-        ],
-        "temperature": 0.2,
-        "max_tokens": 900,
-        "response_format": {"type": "json_schema", "json_schema": HF_JSON_SCHEMA},
-    }
-    resp = requests.post(HF_CHAT_URL, headers=headers, json=payload, timeout=90)
+def build_prompt(petType: str, age: str | None, problem: str, goal: str | None) -> str:
+    # only the context lines vary per request
+    return _PROMPT_PREFIX + (
+        f"Pet type: {petType}\nAge: {age or 'unknown'}\n"
+        f"Problem: {problem}\nDesired outcome: {goal or 'not specified'}"
+    ).rstrip()
+
+_HF_SYSTEM = "Return a SINGLE VALID JSON object matching the schema. No prose/markdown."
+# Request body serialized once around a placeholder; per call only the prompt is encoded.
+_HF_BODY_HEAD, _HF_BODY_TAIL = _json_dumps({
+    "model": HF_MODEL,
+    "messages": [
+        {"role": "system", "content": _HF_SYSTEM},
+        {"role": "user", "content": "__PROMPT__"},
+    ],
+    "temperature": 0.2,
+    "max_tokens": 900,
+    "response_format": {"type": "json_schema", "json_schema": HF_JSON_SCHEMA},
+}).split(b'"__PROMPT__"')
+
+async def call_hf(prompt: str) -> str:
+    body = _HF_BODY_HEAD + _json_dumps(prompt) + _HF_BODY_TAIL
+    for attempt in range(HF_MAX_RETRIES + 1):
+        async with HF_SEM:
+            resp = await http_client.post(HF_CHAT_URL, headers=HF_HEADERS, content=body)
+        if resp.status_code not in HF_RETRY_STATUSES or attempt == HF_MAX_RETRIES:
+            break
+        await asyncio.sleep(0.5 * 2 ** attempt)
     if resp.status_code != 200:
         raise HTTPException(status_code=502, detail=f"HF API {resp.status_code}: {resp.text}")
-    data = resp.json()
+    # decode the envelope straight from the body bytes; skips httpx's text decode
+    data = _json_loads(resp.content)
     choice0 = (data.get("choices") or [{}])[0]
     raw = (choice0.get("message") or {}).get("content") or choice0.get("text") or ""
     if not raw.strip():
         raise HTTPException(status_code=502, detail="HF returned no text content")
     return raw
 
+# Shared, not copied: plans are only serialized, never mutated.
+_PLAN_DEFAULTS = {
+    "title": "Personalized Training Plan", "summary": "", "dailyRoutine": [],
+    "sevenDay": [], "rewards": [], "videoLinks": [], "notes": [],
+}
+_FRIENDLY = {"Dog": "pup", "Cat": "kitty"}
+
+def _plan_seed(body: TrainIn) -> str:
+    return (body.petType + "-" + body.problem).lower().replace(" ", "-")[:24]
+
 def normalize_plan_like_object(plan, body):
     if isinstance(plan, str):
         try:
-            maybe = json.loads(plan)
+            maybe = _json_loads(plan)
             plan = maybe if isinstance(maybe, dict) else {"_data": maybe}
         except Exception:
             plan = {"raw": plan}
@@ -384,89 +820,171 @@ def normalize_plan_like_object(plan, body):
         plan = {"_data": plan}
     elif not isinstance(plan, dict):
         plan = {"value": plan}
-    plan.setdefault("title", "Personalized Training Plan")
-    plan.setdefault("summary", "")
-    plan.setdefault("dailyRoutine", [])
-    plan.setdefault("sevenDay", [])
-    plan.setdefault("rewards", [])
-    plan.setdefault("videoLinks", [])
-    plan.setdefault("notes", [])
-    plan.setdefault("meta", {})
-    plan["meta"].setdefault("seed", (body.petType + "-" + body.problem).lower().replace(" ", "-")[:24])
-    plan.setdefault("friendlyName", "pup" if body.petType == "Dog" else "kitty" if body.petType == "Cat" else "pet")
+    # complete model output skips the per-key fill entirely
+    if _PLAN_DEFAULTS.keys() - plan.keys():
+        for k, v in _PLAN_DEFAULTS.items():
+            if k not in plan:
+                plan[k] = v
+    meta = plan.setdefault("meta", {})
+    if "seed" not in meta:
+        meta["seed"] = _plan_seed(body)
+    if "friendlyName" not in plan:
+        plan["friendlyName"] = _FRIENDLY.get(body.petType, "pet")
     return plan
 
+_TRAIN_ACTIVITIES = [
+    ["Short play + name recall", "Reward calm behavior"],
+    ["Leash walk 10–15 min", "Sit/Stay basics"],
+    ["Targeting (hand touch)", "Crate/Mat training"],
+    ["Impulse control (wait)", "Gentle grooming"],
+    ["Recall games (indoors)", "Loose-leash practice"],
+    ["Novel sound socialization", "Calm enrichment"],
+    ["Review + easy challenge", "Celebrate progress"],
+]
+# Input-independent part of the fallback plan, built once; responses are only
+# serialized, never mutated, so it is shared rather than copied.
+_TRAIN_FALLBACK_STATIC = {
+    "dailyRoutine": ["3–5 short sessions/day", "Fresh water & rest", "End on success"],
+    "sevenDay": [{"day": i+1, "activities": _TRAIN_ACTIVITIES[i]} for i in range(7)],
+    "rewards": ["Tiny treats", "Praise", "Play break"],
+    "videoLinks": [
+        {"title": "Marker & timing basics", "url": "https://youtu.be/dQw4w9WgXcQ"},
+        {"title": "Loose leash intro", "url": "https://youtu.be/o-YBDTqX_ZU"},
+    ],
+    "notes": ["Keep sessions <10 min", "If stress signs appear, pause."],
+}
+
 def _train_fallback(body: TrainIn) -> Dict[str, Any]:
     pet = body.petType
-    friendly = "pup" if pet == "Dog" else "kitty" if pet == "Cat" else "pet"
-    activities = [
-        ["Short play + name recall", "Reward calm behavior"],
-        ["Leash walk 10–15 min", "Sit/Stay basics"],
-        ["Targeting (hand touch)", "Crate/Mat training"],
-        ["Impulse control (wait)", "Gentle grooming"],
-        ["Recall games (indoors)", "Loose-leash practice"],
-        ["Novel sound socialization", "Calm enrichment"],
-        ["Review + easy challenge", "Celebrate progress"],
-    ]
     return {
         "title": f"7-Day {pet} Plan",
         "summary": f"Goal: {body.goal or body.problem}. Gentle, reward-based steps.",
-        "dailyRoutine": ["3–5 short sessions/day", "Fresh water & rest", "End on success"],
-        "sevenDay": [{"day": i+1, "activities": activities[i]} for i in range(7)],
-        "rewards": ["Tiny treats", "Praise", "Play break"],
-        "videoLinks": [
-            {"title": "Marker & timing basics", "url": "https://youtu.be/dQw4w9WgXcQ"},
-            {"title": "Loose leash intro", "url": "https://youtu.be/o-YBDTqX_ZU"},
-        ],
-        "notes": ["Keep sessions <10 min", "If stress signs appear, pause."],
-        "meta": {"seed": (pet + "-" + body.problem).lower().replace(" ", "-")[:24]},
-        "friendlyName": friendly,
+        **_TRAIN_FALLBACK_STATIC,
+        "meta": {"seed": _plan_seed(body)},
+        "friendlyName": _FRIENDLY.get(pet, "pet"),
     }
 
+def _train_key(body: TrainIn) -> str:
+    # case/spacing variants of the free-text fields share one plan; petType is kept
+    # exact because the title, friendlyName and prompt all use it verbatim
+    fields = (body.age or "", body.problem, body.goal or "")
+    norm = "\x1f".join([body.petType, *(_RE_WS.sub(" ", f).strip().lower() for f in fields)])
+    return hashlib.blake2b(norm.encode("utf-8"), digest_size=12).hexdigest()
+
 @app.get("/api/health")
 def health():
-    return {"status": "ok", "gemini": bool(GEMINI_API_KEY), "huggingface_model": HF_MODEL}
+    return {"status": "ok", "gemini": bool(GEMINI_API_KEY), "gemini_degraded": GEMINI_BUCKET.degraded, "gemini_circuit": GEMINI_BREAKER.state, "huggingface_model": HF_MODEL}
+
+async def _hf_plan(prompt: str, body: TrainIn) -> Dict[str, Any]:
+    raw = await call_hf(prompt)
+    try: plan = _json_loads(raw)
+    except Exception: plan = parse_json_loose(raw)
+    return normalize_plan_like_object(plan, body)
+
+async def _gemini_plan(prompt: str, body: TrainIn) -> Dict[str, Any] | None:
+    parts = [{"text": "Return STRICT JSON only."}, {"text": prompt}]
+    data = await GEMINI.submit(parts, temperature=0.2)
+    if data.get("__FALLBACK__") or not isinstance(data, dict) or not data:
+        return None
+    try:
+        return normalize_plan_like_object(data, body)
+    except Exception:
+        return None
 
 @app.post("/api/train")
-def generate_training_plan(body: TrainIn):
+async def generate_training_plan(body: TrainIn):
     if not body.petType or not body.problem:
         raise HTTPException(status_code=400, detail="petType and problem are required")
-    prompt = build_prompt(body.petType, body.age, body.problem, body.goal)
-    key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:24]
-    if key in _TRAIN_CACHE:
-        return _TRAIN_CACHE[key]
-    if not TRAIN_BUCKET.allow():
+    key = _train_key(body)
+    cached = await _TRAIN_CACHE.aget(key)
+    if cached is not None:
+        return cached
+    if not await TRAIN_BUCKET.acquire():
         logger.info("Train RL hit; serving fallback")
-        plan = _train_fallback(body)
-        _TRAIN_CACHE[key] = plan
-        return plan
+        return _train_fallback(body)
+    prompt = build_prompt(body.petType, body.age, body.problem, body.goal)
+    hf = asyncio.ensure_future(_hf_plan(prompt, body))
+    tasks, gem, plan = {hf}, None, None
     try:
-        raw = call_hf(prompt)
-        try: plan = json.loads(raw)
-        except Exception: plan = parse_json_loose(raw)
-        plan = normalize_plan_like_object(plan, body)
-        _TRAIN_CACHE[key] = plan
-        return plan
-    except Exception:
-        logger.exception("HF failed; trying Gemini")
-    parts = [{"text": "Return STRICT JSON only."}, {"text": prompt}]
-    data = _call_gemini_json(GEMINI_MODEL, parts, temperature=0.2)
-    if data.get("__FALLBACK__") or not isinstance(data, dict) or not data:
-        plan = _train_fallback(body)
-    else:
-        try:
-            plan = normalize_plan_like_object(data, body)
-        except Exception:
-            plan = _train_fallback(body)
-    _TRAIN_CACHE[key] = plan
+        if TRAIN_HEDGE_AFTER > 0:
+            await asyncio.wait(tasks, timeout=TRAIN_HEDGE_AFTER)
+            if not hf.done():
+                gem = asyncio.ensure_future(_gemini_plan(prompt, body))
+                tasks.add(gem)
+        # first usable plan wins; HF failing without a hedge starts Gemini
+        while tasks and plan is None:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                if t is hf and t.exception() is not None:
+                    logger.error("HF failed; trying Gemini", exc_info=t.exception())
+                elif plan is None:
+                    plan = t.result()
+            if plan is None and gem is None:
+                gem = asyncio.ensure_future(_gemini_plan(prompt, body))
+                tasks.add(gem)
+    finally:
+        for t in (hf, gem):
+            if t is not None and not t.done():
+                t.cancel()
+    # canned plans aren't cached so the next request retries the models
+    if plan is None:
+        return _train_fallback(body)
+    await _TRAIN_CACHE.aset(key, plan)
     return plan
 
 # ==========================================================
 # 🧩 IMAGE HEALTH
 # ==========================================================
-def _img_key(img_bytes: bytes, animal: str, sex: str) -> str:
-    h = hashlib.sha256(img_bytes).hexdigest()[:16]
-    return f"{h}:{animal}:{sex}"
+def _img_key(digest: str, animal: str, sex: str) -> str:
+    return f"{digest}:{animal}:{sex}"
+
+_UPLOAD_CHUNK = 1 << 20
+MAX_UPLOAD_BYTES = 8 << 20
+
+async def _read_and_digest(upload: UploadFile) -> tuple[bytearray, str]:
+    """Read an upload chunk by chunk, hashing as it arrives; 413 past MAX_UPLOAD_BYTES."""
+    too_big = HTTPException(status_code=413, detail=f"Image too large (max {MAX_UPLOAD_BYTES >> 20} MB)")
+    # the parsed multipart part usually knows its size; refuse before reading any of it
+    if upload.size is not None and upload.size > MAX_UPLOAD_BYTES:
+        raise too_big
+    hasher = hashlib.blake2b(digest_size=8)
+    buf = bytearray()
+    while chunk := await upload.read(_UPLOAD_CHUNK):
+        if len(buf) + len(chunk) > MAX_UPLOAD_BYTES:
+            raise too_big
+        hasher.update(chunk)
+        buf += chunk
+    return buf, hasher.hexdigest()
+
+def _sniff_image(b) -> str | None:
+    """Mime type from the file's magic bytes, or None if it isn't an image we accept."""
+    head = bytes(b[:12])
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"GIF8"):
+        return "image/gif"
+    if head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[4:8] == b"ftyp":
+        if head[8:12] in (b"heic", b"heix", b"hevc", b"hevx"):
+            return "image/heic"
+        if head[8:12] in (b"mif1", b"msf1", b"heif"):
+            return "image/heif"
+    return None
+
+async def _read_image(upload: UploadFile) -> tuple[bytearray, str, str]:
+    """Bytes, digest and sniffed mime of an image upload; 400 if it isn't one."""
+    img_bytes, digest = await _read_and_digest(upload)
+    mime = _sniff_image(img_bytes)
+    if mime is None:
+        raise HTTPException(status_code=400, detail="Invalid image: unrecognized image format")
+    return img_bytes, digest, mime
+
+# CPU-bound on multi-MB uploads; run via asyncio.to_thread to keep the loop free
+def _b64_ascii(data: bytes) -> str:
+    return b64encode(data).decode("ascii")
 
 def _predict_fallback(animal: str, sex: str) -> Dict[str, Any]:
     return {
@@ -483,7 +1001,7 @@ def _predict_fallback(animal: str, sex: str) -> Dict[str, Any]:
         "meta": {"animal": animal, "sex": sex, "notes": "Model unavailable; heuristic fallback."},
     }
 
-def _pet_gate_check(img_b64: str, mime: str) -> Dict[str, Any]:
+async def _pet_gate_check(image_part: Dict[str, Any], digest: str) -> Dict[str, Any]:
     """
     Use Gemini vision to verify the image is a PET photo.
     Returns: {"is_pet": bool|None, "animal": str|None, "confidence": float, "reason": str}
@@ -496,15 +1014,15 @@ def _pet_gate_check(img_b64: str, mime: str) -> Dict[str, Any]:
             "Return STRICT JSON: "
             "{\"is_pet\": boolean, \"animal\": string|null, \"confidence\": number, \"reason\": string}."
         )},
-        {"inline_data": {"mime_type": mime, "data": img_b64}},
+        image_part,
     ]
-    data = _call_gemini_json(GEMINI_MODEL, parts, temperature=0.0)
+    data = await GEMINI.submit(parts, temperature=0.0, blob_key=digest)
     if data.get("__FALLBACK__") or not isinstance(data, dict):
         return {"is_pet": None, "animal": None, "confidence": 0.0, "reason": "model_fallback"}
     try:
         is_pet = data.get("is_pet", None)
         animal = data.get("animal", None)
-        conf = clamp01(data.get("confidence", 0.0))
+        conf = _fastclamp(data.get("confidence", 0.0))
         reason = str(data.get("reason", ""))[:200]
         if isinstance(is_pet, bool):
             return {"is_pet": is_pet, "animal": animal, "confidence": conf, "reason": reason}
@@ -512,21 +1030,35 @@ def _pet_gate_check(img_b64: str, mime: str) -> Dict[str, Any]:
     except Exception:
         return {"is_pet": None, "animal": None, "confidence": 0.0, "reason": "parse_error"}
 
+_PREDICT_SYSTEM = "You are a veterinary assistant analyzing pet skin/wound issues. Return STRICT JSON only."
+# Serialized schema; only meta.animal/meta.sex vary, filled with json.dumps'd values.
+_PREDICT_SCHEMA_TMPL = (
+    '{"predictions": [{"label": "string", "probability": 0.0}], '
+    '"clip_scores": [{"text": "string", "score": 0.0}], '
+    '"meta": {"animal": %s, "sex": %s, "notes": "Short plain sentence."}}'
+)
+
 @app.post("/api/predict")
 async def predict(image: UploadFile = File(...), animal: str = Form("unknown"), sex: str = Form("unknown")):
     # ---------- Read/validate image ----------
-    try:
-        img_bytes = await image.read()
-        Image.open(BytesIO(img_bytes))
-    except Exception as e:
-        logger.exception("Invalid image")
-        raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
+    img_bytes, digest, mime = await _read_image(image)
+
+    # ---------- Cache: only images that passed the gate are ever stored ----------
+    cache_key = _img_key(digest, animal, sex)
+    cached = await _PREDICT_CACHE.aget(cache_key)
+    if cached is not None:
+        return JSONResponse(cached)
 
-    mime = image.content_type or "image/jpeg"
-    img_b64 = base64.b64encode(img_bytes).decode("ascii")
+    # raw bytes: the SDK base64-encodes inline_data once on the wire
+    image_part = {"inline_data": {"mime_type": mime, "data": img_bytes}}
 
     # ---------- PET GATE: block non-pet images with friendly message ----------
-    gate = _pet_gate_check(img_b64, mime)
+    gate = _GATE_CACHE.get(digest)
+    if gate is None:
+        gate = await _pet_gate_check(image_part, digest)
+        # keep decisive verdicts only; a model fallback should be retried next time
+        if gate.get("is_pet") is not None:
+            _GATE_CACHE[digest] = gate
     # If model is confident it's NOT a pet, stop here.
     if gate.get("is_pet") is False and gate.get("confidence", 0.0) >= 0.6:
         msg_en = ("This photo doesn't seem to be a pet. Please upload a clear photo of your pet's "
@@ -540,47 +1072,35 @@ async def predict(image: UploadFile = File(...), animal: str = Form("unknown"),
             },
         )
 
-    # ---------- Cache key only after we allow pet images ----------
-    cache_key = _img_key(img_bytes, animal, sex)
-    if cache_key in _PREDICT_CACHE:
-        return JSONResponse(_PREDICT_CACHE[cache_key])
-
     # ---------- Rate limit ----------
-    if not PREDICT_BUCKET.allow():
+    if not await PREDICT_BUCKET.acquire():
         logger.info("Rate-limited locally; serving fallback for predict()")
-        data = _predict_fallback(animal, sex)
-        _PREDICT_CACHE[cache_key] = data
-        return JSONResponse(data)
+        return JSONResponse(_predict_fallback(animal, sex))
 
     # ---------- Gemini dermatology inference ----------
-    system_rules = "You are a veterinary assistant analyzing pet skin/wound issues. Return STRICT JSON only."
-    schema = {
-        "predictions": [{"label": "string", "probability": 0.0}],
-        "clip_scores": [{"text": "string", "score": 0.0}],
-        "meta": {"animal": animal, "sex": sex, "notes": "Short plain sentence."},
-    }
     user_instruction = (
         f"Animal: {animal}\nSex: {sex}\n\n"
         "Return top 3 likely dermatology issues with probabilities and 3 clip hints (0–1)."
     )
     parts = [
-        {"text": system_rules},
-        {"text": json.dumps(schema)},
+        {"text": _PREDICT_SYSTEM},
+        {"text": _PREDICT_SCHEMA_TMPL % (json.dumps(animal), json.dumps(sex))},
         {"text": user_instruction},
-        {"inline_data": {"mime_type": mime, "data": img_b64}},
+        image_part,
     ]
 
-    data = _call_gemini_json(GEMINI_MODEL, parts, temperature=0.2)
-    if data.get("__FALLBACK__"):
+    data = await GEMINI.submit(parts, temperature=0.2, blob_key=digest)
+    fallback = bool(data.get("__FALLBACK__"))
+    if fallback:
         data = _predict_fallback(animal, sex)
 
     try:
         for p in data.get("predictions", []):
             p["label"] = str(p.get("label", "Unknown"))[:64]
-            p["probability"] = clamp01(p.get("probability", 0.0))
+            p["probability"] = _fastclamp(p.get("probability", 0.0))
         for c in data.get("clip_scores", []):
             c["text"] = str(c.get("text", ""))[:80]
-            c["score"] = clamp01(c.get("score", 0.0))
+            c["score"] = _fastclamp(c.get("score", 0.0))
         if "meta" not in data:
             data["meta"] = {"animal": animal, "sex": sex, "notes": "AI helper, not diagnosis."}
         elif "notes" not in data["meta"]:
@@ -591,8 +1111,11 @@ async def predict(image: UploadFile = File(...), animal: str = Form("unknown"),
         logger.exception("Post-process sanitize failed; supplying fallback")
         data = _predict_fallback(animal, sex)
         data["gate"] = gate
+        fallback = True
 
-    _PREDICT_CACHE[cache_key] = data
+    # like the gate verdicts, only genuine model answers are cached
+    if not fallback:
+        await _PREDICT_CACHE.aset(cache_key, data)
     return JSONResponse(data)
 
 # ==========================================================
@@ -602,120 +1125,109 @@ class VoiceIn(BaseModel):
     audio_b64: str
     mime: Optional[str] = "audio/webm"
 
-def _voice_key(audio_b64: str, mime: str) -> str:
-    return hashlib.sha256((mime + ":" + audio_b64).encode("utf-8")).hexdigest()[:24]
+_VOICE_SCHEMA_JSON = json.dumps({
+    "type":"object","properties":{
+        "disease":{"type":"string"},"confidence":{"type":"number"},
+        "advice":{"type":"array","items":{"type":"string"}},
+        "danger":{"type":"string","enum":["low","medium","high"]},
+        "raw":{"type":"array","items":{"type":"object","properties":{"label":{"type":"string"},"prob":{"type":"number"}},
+                "required":["label","prob"],"additionalProperties":False}}
+    },"required":["disease","confidence","advice","danger"],"additionalProperties":False
+})
+_VOICE_SYSTEM = "You are a careful veterinary assistant listening to short pet audio. Return STRICT JSON only."
+_VOICE_GUIDANCE = "Pick the single most likely issue; give 2–5 short tips; set danger properly; confidence 0–1."
 
-def _voice_fallback() -> Dict[str, Any]:
-    return {
-        "disease": "Unknown",
-        "confidence": 0.0,
-        "advice": [
-            "Keep the room quiet & ventilated.",
-            "Offer fresh water; avoid strong scents.",
-            "If symptoms persist or worsen, see a vet."
-        ],
-        "danger": "low",
-        "raw": [
-            {"label": "cough", "prob": 0.25},
-            {"label": "stress", "prob": 0.22},
-            {"label": "allergy", "prob": 0.18},
-        ],
-    }
+def _voice_key(audio_b64: str, mime: str) -> str:
+    return hashlib.blake2b((mime + ":" + audio_b64).encode("utf-8"), digest_size=12).hexdigest()
+
+_VOICE_FALLBACK: Dict[str, Any] = {
+    "disease": "Unknown",
+    "confidence": 0.0,
+    "advice": [
+        "Keep the room quiet & ventilated.",
+        "Offer fresh water; avoid strong scents.",
+        "If symptoms persist or worsen, see a vet."
+    ],
+    "danger": "low",
+    "raw": [
+        {"label": "cough", "prob": 0.25},
+        {"label": "stress", "prob": 0.22},
+        {"label": "allergy", "prob": 0.18},
+    ],
+}
 
 @app.post("/api/voice/analyze")
-def analyze_voice(body: VoiceIn):
+async def analyze_voice(body: VoiceIn):
     if not body.audio_b64:
         raise HTTPException(status_code=400, detail="audio_b64 is required")
     mime = (body.mime or "audio/webm").strip() or "audio/webm"
 
     key = _voice_key(body.audio_b64, mime)
-    if key in _VOICE_CACHE:
-        return JSONResponse(_VOICE_CACHE[key])
+    cached = await _VOICE_CACHE.aget(key)
+    if cached is not None:
+        return JSONResponse(cached)
 
-    if not VOICE_BUCKET.allow():
+    if not await VOICE_BUCKET.acquire():
         logger.info("Rate-limited locally; serving voice fallback")
-        data = _voice_fallback()
-        _VOICE_CACHE[key] = data
-        return JSONResponse(data)
-
-    schema = {
-        "type":"object","properties":{
-            "disease":{"type":"string"},"confidence":{"type":"number"},
-            "advice":{"type":"array","items":{"type":"string"}},
-            "danger":{"type":"string","enum":["low","medium","high"]},
-            "raw":{"type":"array","items":{"type":"object","properties":{"label":{"type":"string"},"prob":{"type":"number"}},
-                    "required":["label","prob"],"additionalProperties":False}}
-        },"required":["disease","confidence","advice","danger"],"additionalProperties":False
-    }
-
-    system_rules = "You are a careful veterinary assistant listening to short pet audio. Return STRICT JSON only."
-    guidance = "Pick the single most likely issue; give 2–5 short tips; set danger properly; confidence 0–1."
+        return JSONResponse(_VOICE_FALLBACK)
 
     parts = [
-        {"text":system_rules},{"text":"Schema:"},{"text":json.dumps(schema)},
-        {"text":"Instructions:"},{"text":guidance},
+        {"text":_VOICE_SYSTEM},{"text":"Schema:"},{"text":_VOICE_SCHEMA_JSON},
+        {"text":"Instructions:"},{"text":_VOICE_GUIDANCE},
         {"inline_data":{"mime_type":mime,"data":body.audio_b64}}
     ]
 
-    data = _call_gemini_json(GEMINI_MODEL, parts, temperature=0.2)
-    if data.get("__FALLBACK__"):
-        data = _voice_fallback()
+    data = await GEMINI.submit(parts, temperature=0.2, blob_key=key)
+    fallback = bool(data.get("__FALLBACK__"))
+    if fallback:
+        data = _VOICE_FALLBACK
 
     disease = (str(data.get("disease","Unknown")).strip() or "Unknown")[:64]
-    confidence = clamp01(data.get("confidence",0.0))
+    confidence = _fastclamp(data.get("confidence",0.0))
     advice = [str(a)[:160] for a in (data.get("advice") or [])][:5]
     danger = str(data.get("danger","low")).lower()
     if danger not in ("low","medium","high"): danger = "low"
     raw_preds = []
     for r in (data.get("raw") or []):
-        try: raw_preds.append({"label":str(r.get("label",""))[:64],"prob":clamp01(r.get("prob",0.0))})
+        try: raw_preds.append({"label":str(r.get("label",""))[:64],"prob":_fastclamp(r.get("prob",0.0))})
         except Exception: pass
     if not advice:
         advice = ["Monitor breathing tonight.","Keep the room calm & ventilated.","Offer fresh water; avoid strong scents."]
 
     out = {"disease":disease,"confidence":confidence,"advice":advice,"danger":danger,"raw":raw_preds}
-    _VOICE_CACHE[key] = out
+    if not fallback:
+        await _VOICE_CACHE.aset(key, out)
     return JSONResponse(out)
 
 # ==========================================================
 # 🎨 CAPTION
 # ==========================================================
-def _caption_key(img_bytes: bytes, category: str) -> str:
-    h = hashlib.sha256(img_bytes + b"|" + category.encode()).hexdigest()[:24]
-    return f"{h}:{category}"
+def _caption_key(digest: str, category: str) -> str:
+    return f"{digest}:{category}"
 
 @app.post("/generate-caption")
 async def generate_caption(image: UploadFile = File(...), category: str = Form("")):
-    img_bytes = await image.read()
-    try:
-        Image.open(BytesIO(img_bytes))
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
+    img_bytes, digest, mime = await _read_image(image)
 
-    key = _caption_key(img_bytes, category or "")
-    if key in _CAPTION_CACHE:
-        return _CAPTION_CACHE[key]
+    key = _caption_key(digest, category or "")
+    cached = await _CAPTION_CACHE.aget(key)
+    if cached is not None:
+        return _json_body(cached)
 
-    if not CAPTION_BUCKET.allow():
-        out = {"caption": "Cuteness overload 🌟"}
-        _CAPTION_CACHE[key] = out
-        return out
+    if not await CAPTION_BUCKET.acquire():
+        return JSONResponse({"caption": "Cuteness overload 🌟"})
 
-    mime = image.content_type or "image/jpeg"
-    data_b64 = base64.b64encode(img_bytes).decode("ascii")
     prompt = f"Write a {category} style stylish caption (<=80 chars) with emoji and simple English."
-    parts = [{"text":prompt}, {"inline_data":{"mime_type":mime,"data":data_b64}}]
+    parts = [{"text":prompt}, {"inline_data":{"mime_type":mime,"data":img_bytes}}]
 
-    data = _call_gemini_json(GEMINI_MODEL, parts, temperature=0.3)
+    data = await GEMINI.submit(parts, temperature=0.3, blob_key=digest)
     if data.get("__FALLBACK__"):
-        out = {"caption": "Too cute to handle 😍"}
-    else:
-        cap = data if isinstance(data, str) else (data.get("caption") if isinstance(data, dict) else "")
-        if not cap:
-            cap = "Best boy energy ✨"
-        out = {"caption": str(cap).strip()[:120] or "Pet vibes ✨"}
-    _CAPTION_CACHE[key] = out
-    return out
+        return JSONResponse({"caption": "Too cute to handle 😍"})
+    cap = data if isinstance(data, str) else (data.get("caption") if isinstance(data, dict) else "")
+    if not cap:
+        cap = "Best boy energy ✨"
+    out = {"caption": str(cap).strip()[:120] or "Pet vibes ✨"}
+    return await _cache_json(_CAPTION_CACHE, key, out)
 
 # ==========================================================
 # 🐾 RECOMMENDER
@@ -765,25 +1277,35 @@ time: {payload.get('time')}
 name: {payload.get('name') or "unknown"}
 """.strip()
 
-def _rule_based(payload: Dict[str, Any]) -> List[Dict[str, Any]]:
-    want_hypo = (payload.get("allergies","no").lower() == "yes")
-    budget = _parse_int(payload.get("budget"))
-    time = (payload.get("time") or "").lower()
-    lifestyle = (payload.get("lifestyle") or "").lower()
+_RE_COST = re.compile(r"₹\s*([\d,]+)")
+
+@lru_cache(maxsize=2048)
+def _rule_picks(allergies: str, budget: Any, time: Any, lifestyle: Any) -> tuple:
+    want_hypo = (allergies.lower() == "yes")
+    budget = _parse_int(budget)
+    budget_cap = max(budget * 1.2, budget + 1000) if budget else None
+    time = (time or "").lower()
+    lifestyle = (lifestyle or "").lower()
     def ok(item):
         if want_hypo and not item["hypoallergenic"]: return False
-        low = _parse_int(re.search(r"₹\s*([\d,]+)", item["monthly_cost"]).group(1)) if re.search(r"₹\s*([\d,]+)", item["monthly_cost"]) else 0
-        if budget and low > max(budget * 1.2, budget + 1000): return False
+        m = _RE_COST.search(item["monthly_cost"])
+        low = _parse_int(m.group(1)) if m else 0
+        if budget_cap is not None and low > budget_cap: return False
         if "poodle" in item["pet"].lower() or "labrador" in item["pet"].lower():
             if time == "low" or lifestyle == "calm": return False
         return True
     picks = [i for i in CATALOG if ok(i)] or CATALOG[:]
-    return picks[:5]
+    return tuple(picks[:5])
+
+def _rule_based(payload: Dict[str, Any]) -> List[Dict[str, Any]]:
+    # picks are CATALOG entries shared by every caller: replace, never mutate them
+    return list(_rule_picks(payload.get("allergies", "no"), payload.get("budget"),
+                            payload.get("time"), payload.get("lifestyle")))
 
 def _reco_key(payload: Dict[str, Any], img_digest: str | None) -> str:
-    base = json.dumps(payload, sort_keys=True)
-    to_hash = (base + "|" + (img_digest or "")).encode("utf-8")
-    return hashlib.sha256(to_hash).hexdigest()[:24]
+    h = hashlib.blake2b(_json_dumps_sorted(payload), digest_size=12)
+    h.update(b"|" + (img_digest or "").encode("ascii"))
+    return h.hexdigest()
 
 @app.post("/api/recommend")
 async def recommend(
@@ -798,6 +1320,7 @@ async def recommend(
 ):
     payload: Dict[str, Any] = {}
     img_bytes: Optional[bytes] = None
+    img_digest: Optional[str] = None
     img_mime = "image/jpeg"
 
     if json_body:
@@ -814,26 +1337,22 @@ async def recommend(
             "allergies": str(allergies or "no").lower(), "time": str(time), "name": (name or "").strip() or None,
         }
         if image is not None:
-            try:
-                img_bytes = await image.read()
-                Image.open(BytesIO(img_bytes))
-                img_mime = image.content_type or "image/jpeg"
-            except Exception as e:
-                raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
-
-    img_digest = hashlib.sha256(img_bytes).hexdigest()[:16] if img_bytes else None
-    ck = _reco_key(payload, img_digest)
-    if ck in _RECOMMEND_CACHE:
-        return _RECOMMEND_CACHE[ck]
-
-    if not RECOMMEND_BUCKET.allow():
+            img_bytes, img_digest, img_mime = await _read_image(image)
+
+    ck = _reco_key(payload, img_digest if img_bytes else None)
+    cached = await _RECOMMEND_CACHE.aget(ck)
+    if cached is not None:
+        return _json_body(cached)
+
+    if not await RECOMMEND_BUCKET.acquire():
         logger.info("Recommend RL hit; using rule-based")
-        results = _rule_based(payload)
+        results, fallback = _rule_based(payload), True
     else:
         prompt = _pet_reco_prompt(payload)
         parts = [{"text": prompt}]
-        data = _call_gemini_json(GEMINI_MODEL, parts, temperature=0.2)
-        if data.get("__FALLBACK__"):
+        data = await GEMINI.submit(parts, temperature=0.2)
+        fallback = bool(data.get("__FALLBACK__"))
+        if fallback:
             results = _rule_based(payload)
         else:
             try:
@@ -844,10 +1363,8 @@ async def recommend(
     if len(results) < 5:
         results = (results + _rule_based(payload))[:5]
 
-    if img_bytes and results:
-        data_url = f"data:{img_mime};base64,{base64.b64encode(img_bytes).decode('ascii')}"
-        if not (results[0].get("img") or "").strip():
-            results[0]["img"] = data_url
+    if img_bytes and results and not (results[0].get("img") or "").strip():
+        results[0] = {**results[0], "img": f"data:{img_mime};base64,{await asyncio.to_thread(_b64_ascii, img_bytes)}"}
 
     used: set[str] = set()
     normd: List[Dict[str, Any]] = []
@@ -870,9 +1387,9 @@ async def recommend(
             "img": img,
         })
 
-    out = {"results": normd}
-    _RECOMMEND_CACHE[ck] = out
-    return out
+    if fallback:
+        return JSONResponse({"results": normd})
+    return await _cache_json(_RECOMMEND_CACHE, ck, {"results": normd})
 
 # ==========================================================
 # 🥫 FOOD ANALYZER — text or image (OCR + vision)
@@ -892,6 +1409,15 @@ UNIVERSAL_CAUTION = {
     "monosodium glutamate","corn syrup","glucose syrup","maltodextrin",
     "by-product","meat by-product"
 }
+
+def _any_of(terms) -> re.Pattern:
+    # one C-level scan per ingredient instead of a Python loop of `in` checks
+    return re.compile("|".join(map(re.escape, sorted(terms))))
+
+_HARMFUL_RE = {"dog": _any_of(DOG_HARMFUL), "cat": _any_of(CAT_HARMFUL)}
+_HARMFUL_ANY_RE = _any_of(DOG_HARMFUL | CAT_HARMFUL)
+_CAUTION_RE = _any_of(UNIVERSAL_CAUTION)
+
 BETTER_BRANDS = ["Orijen","Acana","Royal Canin","Farmina N&D","Drools Focus"]
 
 # --- Energy density & safety DB (kcal per gram)
@@ -911,19 +1437,32 @@ FOOD_DB = {
     "egg":            {"kcal_g": 1.6, "pet_ok": True, "tags": ["protein","fat"]},
     "carrot":         {"kcal_g": 0.4, "pet_ok": True, "tags": ["veggie"]},
 }
+_UNKNOWN_FOOD = {"kcal_g": 2.5, "pet_ok": False, "tags": ["unknown"]}
+_HIGH_KCAL = 3.5  # kcal/g at or above which a food counts as energy-dense
+
+@lru_cache(maxsize=1024)
+def _match_food(name: str) -> str | None:
+    # first FOOD_DB key that contains the name or is contained in it; names repeat a lot
+    for k in FOOD_DB:
+        if k in name or name in k:
+            return k
+    return None
 
-def _food_key(text: str|None, img_bytes: bytes|None) -> str:
+def _food_key(text: str|None, img_digest: str|None) -> str:
     if text and text.strip():
-        return "T:" + hashlib.sha256(text.strip().lower().encode()).hexdigest()[:24]
-    if img_bytes:
-        return "I:" + hashlib.sha256(img_bytes).hexdigest()[:24]
+        return "T:" + hashlib.blake2b(text.strip().lower().encode(), digest_size=12).hexdigest()
+    if img_digest:
+        return "I:" + img_digest
     return "food:empty"
 
+_RE_NON_LABEL = re.compile(r"[^a-z0-9, \-\(\)\/\.]")
+_RE_ING_SEP = re.compile(r",|\n")
+
 def _split_ingredients(raw: str) -> list[str]:
     t = (raw or "").lower()
-    t = re.sub(r"[^a-z0-9, \-\(\)\/\.]", " ", t)
-    parts = [p.strip(" .") for p in re.split(r",|\n", t) if p.strip()]
-    norm = [re.sub(r"\s+", " ", p) for p in parts]
+    t = _RE_NON_LABEL.sub(" ", t)
+    parts = [p.strip(" .") for p in _RE_ING_SEP.split(t) if p.strip()]
+    norm = [_RE_WS.sub(" ", p) for p in parts]
     seen=set(); out=[]
     for p in norm:
         if p not in seen:
@@ -931,20 +1470,25 @@ def _split_ingredients(raw: str) -> list[str]:
     return out[:60]
 
 def _score_food(ings: list[str], animal: str) -> dict:
+    return _score_food_cached(tuple(ings), animal)
+
+@lru_cache(maxsize=4096)
+def _score_food_cached(ings: tuple, animal: str) -> dict:
+    # cached result is shared; callers only read it
     a = (animal or "").strip().lower()
-    harmful_set = DOG_HARMFUL if a == "dog" else CAT_HARMFUL if a == "cat" else DOG_HARMFUL | CAT_HARMFUL
-    harmful, caution = [], []
+    harmful_re = _HARMFUL_RE.get(a, _HARMFUL_ANY_RE)
+    # ordered dedupe, capped at 12 each; stop scanning once both are full
+    seen_h: dict[str, None] = {}
+    seen_c: dict[str, None] = {}
     for item in ings:
-        base = item
-        for h in harmful_set:
-            if h in base:
-                harmful.append(item); break
-        else:
-            for c in UNIVERSAL_CAUTION:
-                if c in base:
-                    caution.append(item); break
-    harmful = list(dict.fromkeys(harmful))[:12]
-    caution = list(dict.fromkeys(caution))[:12]
+        if harmful_re.search(item):
+            if len(seen_h) < 12:
+                seen_h[item] = None
+        elif len(seen_c) < 12 and _CAUTION_RE.search(item):
+            seen_c[item] = None
+        if len(seen_h) >= 12 and len(seen_c) >= 12:
+            break
+    harmful, caution = list(seen_h), list(seen_c)
     if harmful:
         rating = "bad"
     elif len(caution) >= 2:
@@ -953,12 +1497,16 @@ def _score_food(ings: list[str], animal: str) -> dict:
         rating = "good"
     return {"rating": rating, "harmful": harmful, "caution": caution}
 
+@lru_cache(maxsize=256)
+def _rer_kcal(animal: str, weight_kg: float) -> float:
+    # daily energy need: resting rate 70·kg^0.75, x1.2 for cats, x1.4 otherwise
+    a = (animal or "").strip().lower()
+    return (70 * (weight_kg ** 0.75)) * (1.2 if a == "cat" else 1.4)
+
 def _estimate_qty_grams(animal: str, weight_kg: float|None) -> int:
     if not weight_kg:
         return 180
-    a = (animal or "").strip().lower()
-    kcal = (70 * (weight_kg ** 0.75)) * (1.2 if a == "cat" else 1.4)
-    grams = int(kcal / 3.5)
+    grams = int(_rer_kcal(animal, weight_kg) / 3.5)
     return max(60, min(grams, 400))
 
 def _items_to_table(items: list[dict], animal: str, daily_kcal: int) -> list[dict]:
@@ -966,20 +1514,15 @@ def _items_to_table(items: list[dict], animal: str, daily_kcal: int) -> list[dic
     for it in items:
         name = (it.get("name") or "").strip().lower()
         grams = float(it.get("grams") or 0) if str(it.get("grams") or "").strip() else None
-        key = None
-        for k in FOOD_DB.keys():
-            if k in name or name in k:
-                key = k; break
-        info = FOOD_DB.get(key or name)
-        if not info:
-            info = {"kcal_g": 2.5, "pet_ok": False, "tags": ["unknown"]}
+        key = _match_food(name)
+        info = FOOD_DB.get(key or name) or _UNKNOWN_FOOD
         kcal_g = float(info["kcal_g"])
         est_kcal = int(round(kcal_g * (grams or 100)))
         pet_ok = bool(info["pet_ok"])
-        flag = "unsafe" if not pet_ok else ("high-calorie" if kcal_g >= 3.5 else "ok")
+        flag = "unsafe" if not pet_ok else ("high-calorie" if kcal_g >= _HIGH_KCAL else "ok")
         if not pet_ok:
             suggestion = "Avoid for pets."
-        elif kcal_g >= 3.5:
+        elif kcal_g >= _HIGH_KCAL:
             suggestion = "Limit; very energy-dense."
         else:
             max_g = int((0.1 * daily_kcal) / max(kcal_g, 0.1))
@@ -1019,25 +1562,22 @@ async def food_analyze(
         ingredients = json_body.ingredients
 
     img_bytes = None
+    img_digest = None
     mime = "image/jpeg"
     if mode == "image":
         if image is None:
             raise HTTPException(status_code=400, detail="image required for mode=image")
-        try:
-            img_bytes = await image.read()
-            Image.open(BytesIO(img_bytes))
-            mime = image.content_type or "image/jpeg"
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
+        img_bytes, img_digest, mime = await _read_image(image)
     else:
         if not (ingredients and ingredients.strip()):
             raise HTTPException(status_code=400, detail="ingredients text required for mode=text")
 
-    ck = _food_key(ingredients, img_bytes)
-    if ck in _FOOD_CACHE:
-        return JSONResponse(_FOOD_CACHE[ck])
+    ck = _food_key(ingredients, img_digest if img_bytes else None)
+    cached = await _FOOD_CACHE.aget(ck)
+    if cached is not None:
+        return _json_body(cached)
 
-    if not FOOD_BUCKET.allow():
+    if not await FOOD_BUCKET.acquire():
         logger.info("Food RL hit; returning rule-based only")
         ings = _split_ingredients(ingredients or "")
         scored = _score_food(ings, animal)
@@ -1049,37 +1589,44 @@ async def food_analyze(
             "source": {"from": "rate-limit"},
             "ingredients": ings,
         }
-        _FOOD_CACHE[ck] = out
         return JSONResponse(out)
 
     # ---------- Image mode: OCR + Vision ----------
     ocr_text = None
     vision_items = []
+    fallback = False
     if mode == "image":
-        _b64 = base64.b64encode(img_bytes).decode("ascii")
+        # raw bytes: the SDK base64-encodes inline_data once on the wire
+        image_part = {"inline_data": {"mime_type": mime, "data": img_bytes}}
 
-        # (1) OCR label
+        # OCR of the label and food detection are independent; run both at once
         ocr_parts = [
             {"text": "Extract the ingredient list from this pet food label. Return STRICT JSON: {\"ingredients\": string}."},
-            {"inline_data": {"mime_type": mime, "data": _b64}},
+            image_part,
         ]
-        ocr = _call_gemini_json(GEMINI_MODEL, ocr_parts, temperature=0.0)
-        if not ocr.get("__FALLBACK__"):
-            try:
-                ocr_text = (ocr.get("ingredients") or "").strip() or None
-            except Exception:
-                ocr_text = None
-
-        # (2) Vision items (works for junk-food photos)
         det_parts = [
             {"text": (
                 "Look at the photo and list human foods you see. "
                 "Return STRICT JSON: {\"items\": [{\"name\": string, \"grams\": number|null}]} . "
                 "Use simple names like burger, fried chicken, donut, pizza, cookies, soda, chocolate."
             )},
-            {"inline_data": {"mime_type": mime, "data": _b64}},
+            image_part,
         ]
-        det = _call_gemini_json(GEMINI_MODEL, det_parts, temperature=0.0)
+        ocr, det = await asyncio.gather(
+            GEMINI.submit(ocr_parts, temperature=0.0, blob_key=img_digest),
+            GEMINI.submit(det_parts, temperature=0.0, blob_key=img_digest),
+        )
+
+        fallback = bool(ocr.get("__FALLBACK__") or det.get("__FALLBACK__"))
+
+        # (1) OCR label
+        if not ocr.get("__FALLBACK__"):
+            try:
+                ocr_text = (ocr.get("ingredients") or "").strip() or None
+            except Exception:
+                ocr_text = None
+
+        # (2) Vision items (works for junk-food photos)
         if not det.get("__FALLBACK__"):
             try:
                 vision_items = det.get("items") or []
@@ -1096,13 +1643,13 @@ async def food_analyze(
     scored = _score_food(ings, animal)
 
     # per-item kcal table + stronger verdict for junk images
-    daily_kcal = int((70 * ((float(weight_kg) if weight_kg else 8.0) ** 0.75)) * (1.2 if animal=="cat" else 1.4))
+    daily_kcal = int(_rer_kcal(animal, float(weight_kg) if weight_kg else 8.0))
     table = _items_to_table(vision_items, animal, daily_kcal) if vision_items else []
     if mode == "image" and table:
         if any(not r["pet_ok"] for r in table):
             rating = "bad"
         else:
-            rating = "caution" if any(r["kcal_g"] >= 3.5 for r in table) else scored["rating"]
+            rating = "caution" if any(r["kcal_g"] >= _HIGH_KCAL for r in table) else scored["rating"]
     else:
         rating = scored["rating"]
 
@@ -1118,13 +1665,15 @@ async def food_analyze(
         },
         "ingredients": ings,
     }
-    _FOOD_CACHE[ck] = out
-    return JSONResponse(out)
+    # a label read without the model is incomplete; don't pin it in the cache
+    if fallback:
+        return JSONResponse(out)
+    return await _cache_json(_FOOD_CACHE, ck, out)
 
 # ==========================================================
 # 🩺 HEALTH LOG ANALYZER (Firestore integration via frontend)
 # ==========================================================
-ANALYTICS_BUCKET = TokenBucket(capacity=5, refill_per_sec=2.0, tokens=5.0, last=time.time())
+ANALYTICS_BUCKET = TokenBucket(capacity=5, refill_per_sec=2.0, tokens=5.0, last=time.time(), name="analytics")
 
 class HealthEntry(BaseModel):
     dateISO: Optional[str] = None
@@ -1138,6 +1687,17 @@ class HealthEntry(BaseModel):
 class AnalyzeLogsIn(BaseModel):
     logs: List[HealthEntry]
 
+_HEALTH_SCHEMA_JSON = json.dumps({
+    "type": "object",
+    "properties": {
+        "status": {"type": "string", "enum": ["good", "watch", "bad"]},
+        "score": {"type": "number"},
+        "reasons": {"type": "array", "items": {"type": "string"}},
+        "tips": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["status", "score"],
+})
+
 def _rule_health(entries: List[HealthEntry]) -> Dict[str, Any]:
     """Fallback if Gemini quota/rate-limit — lightweight rule check."""
     if not entries:
@@ -1148,19 +1708,18 @@ def _rule_health(entries: List[HealthEntry]) -> Dict[str, Any]:
             "tips": ["Add daily logs", "Monitor appetite and water intake"],
         }
 
-    bad_flags = 0
-    warn_flags = 0
-    total_water = 0
-    total_activity = 0
+    bad_flags = warn_flags = 0
+    total_water = total_activity = 0.0
     n = min(7, len(entries))
 
+    # one pass, flags summed as bools instead of branched on
     for e in entries[:n]:
-        if (e.vomit or "").lower() == "yes": bad_flags += 1
-        if (e.diarrhea or "").lower() == "yes": bad_flags += 1
-        if not e.water or e.water < 100: warn_flags += 1
-        if not e.activity or e.activity < 10: warn_flags += 1
-        total_water += float(e.water or 0)
-        total_activity += float(e.activity or 0)
+        w = e.water or 0
+        a = e.activity or 0
+        bad_flags += ((e.vomit or "").lower() == "yes") + ((e.diarrhea or "").lower() == "yes")
+        warn_flags += (w < 100) + (a < 10)
+        total_water += w
+        total_activity += a
 
     reasons = []
     if bad_flags >= 2:
@@ -1192,18 +1751,17 @@ def _rule_health(entries: List[HealthEntry]) -> Dict[str, Any]:
     return {"status": status, "score": score, "reasons": reasons or ["All good!"], "tips": tips}
 
 @app.post("/api/health/analyze-logs")
-def analyze_logs(body: AnalyzeLogsIn):
+async def analyze_logs(body: AnalyzeLogsIn):
     if not body.logs:
         raise HTTPException(status_code=400, detail="logs are required")
 
     # Rate limit check
-    if not ANALYTICS_BUCKET.allow():
+    if not await ANALYTICS_BUCKET.acquire():
         return JSONResponse(_rule_health(body.logs))
 
-    # Prepare compact rows
-    rows = []
-    for e in body.logs[:7]:
-        rows.append({
+    # Prepare compact rows (prompt key names and null->default filling are part of the prompt contract)
+    rows = [
+        {
             "date": e.dateISO,
             "food": e.food or "",
             "water_ml": e.water or 0,
@@ -1211,29 +1769,20 @@ def analyze_logs(body: AnalyzeLogsIn):
             "diarrhea": e.diarrhea or "no",
             "activity_min": e.activity or 0,
             "notes": e.notes or "",
-        })
-
-    schema = {
-        "type": "object",
-        "properties": {
-            "status": {"type": "string", "enum": ["good", "watch", "bad"]},
-            "score": {"type": "number"},
-            "reasons": {"type": "array", "items": {"type": "string"}},
-            "tips": {"type": "array", "items": {"type": "string"}},
-        },
-        "required": ["status", "score"],
-    }
+        }
+        for e in body.logs[:7]
+    ]
 
     parts = [
         {"text": "You are a veterinary assistant analyzing a pet's daily health logs."},
         {"text": "Return STRICT JSON following this schema:"},
-        {"text": json.dumps(schema)},
+        {"text": _HEALTH_SCHEMA_JSON},
         {"text": "Use status: 'good', 'watch', or 'bad'."},
         {"text": "Recent logs (latest first):"},
-        {"text": json.dumps(rows)},
+        {"text": _json_dumps(rows).decode("utf-8")},
     ]
 
-    data = _call_gemini_json(GEMINI_MODEL, parts, temperature=0.1)
+    data = await GEMINI.submit(parts, temperature=0.1)
     if data.get("__FALLBACK__") or not isinstance(data, dict) or "status" not in data:
         return JSONResponse(_rule_health(body.logs))
 
@@ -1250,3 +1799,27 @@ def analyze_logs(body: AnalyzeLogsIn):
         "reasons": reasons,
         "tips": tips,
     })
+
+if __name__ == "__main__":
+    import uvicorn
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    if workers > 1 and redis_client is None:
+        logger.warning("WEB_CONCURRENCY=%d without REDIS_URL: caches and rate limits are per worker", workers)
+    try:
+        import uvloop  # noqa: F401  libuv event loop
+        loop = "uvloop"
+    except ImportError:
+        loop = "asyncio"
+    try:
+        import httptools  # noqa: F401  C HTTP parser
+        http = "httptools"
+    except ImportError:
+        http = "h11"
+    uvicorn.run(
+        "main:app",
+        host=os.getenv("HOST", "127.0.0.1"),
+        port=int(os.getenv("PORT", "8000")),
+        workers=workers,
+        loop=loop,
+        http=http,
+    )
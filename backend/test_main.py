@@ -0,0 +1,59 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+os.environ.setdefault("GEMINI_API_KEY", "test")
+os.environ.setdefault("HF_TOKEN", "test")
+
+import main
+
+N = 32 * 1024
+
+@pytest.mark.parametrize("text", [
+    '{"a":1,' + '"\\' * N,
+    "{'a':1," + "'\\" * N,
+    '{"a":1,' + '"\\\n' * N,
+], ids=["double", "single", "double-newline"])
+def test_parse_json_loose_unterminated_strings_stay_linear(text):
+    start = time.perf_counter()
+    with pytest.raises(ValueError):
+        main.parse_json_loose(text)
+    # was quadratic: several seconds at this size
+    assert time.perf_counter() - start < 0.5
+
+@pytest.mark.parametrize("text, expected", [
+    ('{a: "x, y: z", b: 1,}', {"a": "x, y: z", "b": 1}),
+    ("{'a': \"it's\", b: [1, 2,],}", {"a": "it's", "b": [1, 2]}),
+    ('{"plan": 1}\n\nLet me know if you need {more}', {"plan": 1}),
+])
+def test_parse_json_loose_repairs(text, expected):
+    assert main.parse_json_loose(text) == expected
+
+def test_train_fallback_is_not_cached(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    async def hf_down(*args, **kwargs):
+        raise RuntimeError("hf down")
+
+    monkeypatch.setattr(main, "_hf_plan", hf_down)
+    monkeypatch.setattr(main.GEMINI_BREAKER, "state", "open")
+    monkeypatch.setattr(main.GEMINI_BREAKER, "opened_at", time.time())
+    main._TRAIN_CACHE.clear()
+    r = TestClient(main.app).post("/api/train", json={"petType": "dog", "problem": "barking"})
+    assert r.status_code == 200 and r.json()
+    assert len(main._TRAIN_CACHE) == 0
+
+def test_unparseable_gemini_reply_leaves_breaker_closed(monkeypatch):
+    class Reply:
+        text = '{"a":1,' + '"\\' * 8
+
+    async def generate_content(**kwargs):
+        return Reply()
+
+    monkeypatch.setattr(main.gemini_client.aio.models, "generate_content", generate_content)
+    monkeypatch.setattr(main.GEMINI_BREAKER, "state", "closed")
+    monkeypatch.setattr(main.GEMINI_BREAKER, "failures", 0)
+    assert asyncio.run(main._call_gemini_json("m", [{"text": "x"}])) == {}
+    assert main.GEMINI_BREAKER.failures == 0